@@ -1,24 +1,48 @@
 #!/usr/bin/python3
+import argparse
+import asyncio
 import concurrent.futures
 import socket
 import time
-import pandas as pd
+from collections import namedtuple
+import xlsxwriter
 from tqdm import tqdm
-from multiprocessing import Manager, Value, Lock
 import subprocess
 import re
 
+# Precompiled patterns for target files and paping output
+_VALID_LINE_RE = re.compile(r'^[a-zA-Z0-9\.\-: ]*$')
+_ANSI_RE = re.compile(r'\x1b\[\d+(;\d+)*m')
+
+# Single pass over paping output, color codes may surround any value
+_ANSI = r'(?:\x1b\[\d+(?:;\d+)*m)*'
+_PAPING_RE = re.compile(
+    rf"(?P<connect>Connecting to {_ANSI}(?P<ip>\d+\.\d+\.\d+\.\d+){_ANSI} on {_ANSI}TCP (?P<port>\d+){_ANSI}:)"
+    rf"|(?P<stats>Attempted\s*=\s*{_ANSI}(?P<attempted>\d+){_ANSI},\s*Connected\s*=\s*{_ANSI}(?P<connected>\d+){_ANSI},"
+    rf"\s*Failed\s*=\s*{_ANSI}(?P<failed>\d+){_ANSI}\s*\({_ANSI}(?P<loss>[\d.]+)\s*%{_ANSI}\))"
+    rf"|(?P<times>Minimum\s*=\s*{_ANSI}(?P<min>[\d.]+){_ANSI}\s*ms{_ANSI},\s*Maximum\s*=\s*{_ANSI}(?P<max>[\d.]+){_ANSI}\s*ms{_ANSI},"
+    rf"\s*Average\s*=\s*{_ANSI}(?P<avg>[\d.]+){_ANSI}\s*ms)"
+)
+
+# Columns of the Excel results sheet
+RESULT_COLUMNS = ['domain', 'ip', 'port', 'attempted', 'connected', 'failed', 'packet_loss_rate', 'min_time', 'max_time', 'avg_time']
+
+# Result record of a single target, fields in Excel column order
+TestResult = namedtuple('TestResult', RESULT_COLUMNS)
+
+# Number of concurrent native probes allowed per requested process
+PROBES_PER_PROCESS = 50
+
 # Read the list of IP/domain and ports
 def read_targets(filename, default_ports):
     targets = []
-    valid_line_pattern = re.compile(r'^[a-zA-Z0-9\.\-: ]*$')
 
     with open(filename, 'r') as file:
         for line in file:
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
-            if not valid_line_pattern.match(line):
+            if not _VALID_LINE_RE.match(line):
                 raise ValueError(f"Invalid character detected in line: {line}")
             if ':' in line:
                 target, port = line.split(':')
@@ -48,11 +72,15 @@ def resolve_domain(target):
     except socket.gaierror:
         return None
 
+# Resolve each distinct target once, concurrently, and return (target, ip, port) triples
+def resolve_targets(targets, max_workers):
+    unique_targets = list(dict.fromkeys(target for target, _ in targets))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resolved = dict(zip(unique_targets, executor.map(resolve_domain, unique_targets)))
+    return [(target, resolved[target], port) for target, port in targets]
+
 # Parse the output of paping
 def parse_paping_output(output):
-    # Remove color codes
-    output = re.sub(r'\x1b\[\d+(;\d+)*m', '', output)
-    lines = output.splitlines()
     results = {
         'attempted': 0,
         'connected': 0,
@@ -65,15 +93,6 @@ def parse_paping_output(output):
     if paping_debug:
         print("👇 ***** task start ***** 👇")
         print("\n")
-        if "Connecting to" in output:
-            match = re.search(r"Connecting to (\d+\.\d+\.\d+\.\d+) on TCP (\d+):", output)
-            if match:
-                ip_address = match.group(1)
-                port = match.group(2)
-                print(f"⚠  {ip_address}, Port: {port}")
-                print("\n")
-            else:
-                print("No IP address found.")
 
     if "Cannot resolve host" in output:
         results['attempted'] = 1
@@ -85,186 +104,196 @@ def parse_paping_output(output):
         results['avg_time'] = 0.0
         return results
 
-    for line in lines:
-        if "Attempted" in line:
-            parts = line.split(',')
-            results['attempted'] = int(parts[0].split('=')[1].strip())
-            results['connected'] = int(parts[1].split('=')[1].strip())
-            results['failed'] = int(parts[2].split('=')[1].strip().split(' ')[0])
-            results['packet_loss_rate'] = float(parts[2].split('(')[1].split(')')[0].replace('%', '').strip())
-            if paping_debug:
-                print("--- line start ---")
-                print(line)
-                print("- parsed -")
-                print(results)
-                print("--- line end ---")
-                print("\n")
-        if "Minimum" in line:
-            parts = line.split(',')
-            results['min_time'] = float(parts[0].split('=')[1].replace('ms', '').strip())
-            results['max_time'] = float(parts[1].split('=')[1].replace('ms', '').strip())
-            results['avg_time'] = float(parts[2].split('=')[1].replace('ms', '').strip())
+    for match in _PAPING_RE.finditer(output):
+        kind = match.lastgroup
+        if kind == 'connect':
             if paping_debug:
-                print("--- line start ---")
-                print(line)
-                print("- parsed -")
-                print(results)
-                print("--- line end ---")
+                print(f"⚠  {match.group('ip')}, Port: {match.group('port')}")
                 print("\n")
+            continue
+        if kind == 'stats':
+            results['attempted'] = int(match.group('attempted'))
+            results['connected'] = int(match.group('connected'))
+            results['failed'] = int(match.group('failed'))
+            results['packet_loss_rate'] = float(match.group('loss'))
+        elif kind == 'times':
+            results['min_time'] = float(match.group('min'))
+            results['max_time'] = float(match.group('max'))
+            results['avg_time'] = float(match.group('avg'))
+        if paping_debug:
+            print("--- line start ---")
+            print(_ANSI_RE.sub('', match.group(0)))
+            print("- parsed -")
+            print(results)
+            print("--- line end ---")
+            print("\n")
     if paping_debug:
         print("👆 ***** task end ***** 👆")
         print("\n")
     return results
 
 # Test TCP port connectivity of a single target using paping
-def test_port_with_paping(target, port, attempts, interval, progress_counter, lock):
-    ip = resolve_domain(target)
+# Deprecated: kept for backward compatibility, the native asyncio method avoids a fork per target
+def test_port_with_paping(target, ip, port, attempts, interval):
     domain = target if not is_valid_ip(target) else ''
 
     try:
         cmd = ['paping', ip, '-p', str(port), '-c', str(attempts)]
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
-        output = ""
-        while True:
-            line = process.stdout.readline()
-            if not line:
-                break
-            output += line
-            with lock:
-                progress_counter.value += 1
-
-        process.wait()
+        # Drain the output in one go, paping only prints a few lines per attempt
+        output, _ = process.communicate()
     except Exception as e:
         output = str(e)
 
-    results = parse_paping_output(output)
-    results['domain'] = domain
-    results['ip'] = ip
-    results['port'] = port
-
-    return results
+    return TestResult(domain=domain, ip=ip, port=port, **parse_paping_output(output))
+
+# Build the result of a target from the connect times of its successful attempts
+def summarize_attempts(domain, ip, port, attempts, times):
+    connected = len(times)
+    failed = attempts - connected
+    return TestResult(
+        domain=domain,
+        ip=ip,
+        port=port,
+        attempted=attempts,
+        connected=connected,
+        failed=failed,
+        packet_loss_rate=(failed / attempts) * 100,
+        min_time=min(times) if times else 0,
+        max_time=max(times) if times else 0,
+        avg_time=sum(times) / connected if times else 0
+    )
+
+# Time a single TCP connect, return the elapsed time in ms or None on failure
+async def probe_port(ip, port):
+    try:
+        start_time = time.perf_counter()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=2)
+        elapsed_time = (time.perf_counter() - start_time) * 1000
+        writer.close()
+        return elapsed_time
+    except (OSError, asyncio.TimeoutError):
+        return None
 
-# Test TCP port connectivity of a single target using Python
-def test_port_with_python(target, port, attempts, interval, progress_counter, lock):
-    ip = resolve_domain(target)
+# Test TCP port connectivity of a single target using asyncio
+# With parallel set, attempts start every interval seconds without waiting for the previous one
+async def test_port_with_asyncio(target, ip, port, attempts, interval, parallel=False):
     domain = target if not is_valid_ip(target) else ''
-    results = {
-        'domain': domain,
-        'ip': ip,
-        'port': port,
-        'attempted': attempts,
-        'connected': 0,
-        'failed': 0,
-        'packet_loss_rate': 0.0,
-        'min_time': float('inf'),
-        'max_time': float('-inf'),
-        'avg_time': 0
-    }
-
-    total_time = 0
-
-    for _ in range(attempts):
-        try:
-            start_time = time.time()
-            with socket.create_connection((ip, port), timeout=2) as sock:
-                pass
-            end_time = time.time()
-            elapsed_time = (end_time - start_time) * 1000
-
-            results['connected'] += 1
-            total_time += elapsed_time
-
-            if elapsed_time < results['min_time']:
-                results['min_time'] = elapsed_time
-            if elapsed_time > results['max_time']:
-                results['max_time'] = elapsed_time
-        except socket.error:
-            results['failed'] += 1
+    elapsed_times = []
+
+    async def probe_at(attempt):
+        await asyncio.sleep(attempt * interval)
+        return await probe_port(ip, port)
+
+    if ip is not None:
+        if parallel:
+            elapsed_times = await asyncio.gather(*(probe_at(attempt) for attempt in range(attempts)))
+        else:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(interval)
+                elapsed_times.append(await probe_port(ip, port))
+
+    times = [elapsed_time for elapsed_time in elapsed_times if elapsed_time is not None]
+    return summarize_attempts(domain, ip, port, attempts, times)
+
+# Test all targets with paping in a process pool, one target per task
+def run_paping_tests(targets, attempts, interval, max_processes, total_pings):
+    results = []
+
+    # Create a process pool executor
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_processes) as executor:
+        future_to_target = {
+            executor.submit(
+                test_port_with_paping, 
+                target, 
+                ip, 
+                port, 
+                attempts, 
+                interval
+            ): (target, port)
+            for target, ip, port in targets
+        }
+
+        # Use tqdm progress bar, advanced as each target completes
+        with tqdm(total=total_pings, desc="Testing progress") as pbar:
+            for future in concurrent.futures.as_completed(future_to_target):
+                pbar.update(attempts)
+                target, port = future_to_target[future]
+                try:
+                    result = future.result()
+                    results.append(result)
+                except Exception as exc:
+                    print(f'{target}:{port} generated an exception: {exc}')
 
-        time.sleep(interval)
-
-        with lock:
-            progress_counter.value += 1
-
-    if results['connected'] > 0:
-        results['avg_time'] = total_time / results['connected']
-    else:
-        results['min_time'] = 0
-        results['max_time'] = 0
-
-    results['packet_loss_rate'] = (results['failed'] / results['attempted']) * 100
+    return results
 
+# Test all targets natively in one event loop, at most max_concurrency targets at a time
+def run_asyncio_tests(targets, attempts, interval, max_concurrency, total_pings, parallel_attempts=False):
+    async def run_one(semaphore, pbar, target, ip, port):
+        async with semaphore:
+            try:
+                return await test_port_with_asyncio(target, ip, port, attempts, interval, parallel_attempts)
+            except Exception as exc:
+                return exc
+            finally:
+                pbar.update(attempts)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        with tqdm(total=total_pings, desc="Testing progress") as pbar:
+            return await asyncio.gather(*(run_one(semaphore, pbar, target, ip, port) for target, ip, port in targets))
+
+    results = []
+    for (target, _, port), result in zip(targets, asyncio.run(run_all())):
+        if isinstance(result, Exception):
+            print(f'{target}:{port} generated an exception: {result}')
+        else:
+            results.append(result)
     return results
 
 # Batch testing
-def run_tests(filename, attempts, interval, max_processes, default_ports, use_paping, output_file, print_results):
-    targets = read_targets(filename, default_ports)
+def run_tests(filename, attempts, interval, max_processes, default_ports, use_paping, output_file, print_results, parallel_attempts=False):
+    targets = resolve_targets(read_targets(filename, default_ports), max_processes * PROBES_PER_PROCESS)
     total_pings = len(targets) * attempts
 
-    with Manager() as manager:
-        progress_counter = manager.Value('i', 0)
-        lock = manager.Lock()
-
-        results = []
-
-        # Select the test function
-        test_func = test_port_with_paping if use_paping else test_port_with_python
-
-        # Create a process pool executor
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_processes) as executor:
-            future_to_target = {
-                executor.submit(
-                    test_func, 
-                    target, 
-                    port, 
-                    attempts, 
-                    interval, 
-                    progress_counter, 
-                    lock
-                ): (target, port)
-                for target, port in targets
-            }
-
-            # Use tqdm progress bar
-            with tqdm(total=total_pings, desc="Testing progress") as pbar:
-                while progress_counter.value < total_pings:
-                    with lock:
-                        pbar.update(progress_counter.value - pbar.n)
-                    time.sleep(0.1)
-
-                # Handle completed tasks
-                for future in concurrent.futures.as_completed(future_to_target):
-                    target, port = future_to_target[future]
-                    try:
-                        result = future.result()
-                        results.append(result)
-                    except Exception as exc:
-                        print(f'{target}:{port} generated an exception: {exc}')
-
-        # Sort results by IP address and port, handle None values
-        results.sort(key=lambda x: (x['ip'] if x['ip'] is not None else '', x['port']))
-
-        # Print results
-        if print_results:
-            for result in results:
-                domain_display = result['domain'] if result['domain'] else '-'
-                print(f"{domain_display} ({result['ip']}):{result['port']} - Attempted = {result['attempted']}, "
-                      f"Connected = {result['connected']}, Failed = {result['failed']}, "
-                      f"Loss = {result['packet_loss_rate']:.2f}%, "
-                      f"Min = {result['min_time']:.2f}ms, Max = {result['max_time']:.2f}ms, "
-                      f"Avg = {result['avg_time']:.2f}ms")
-
-        # Save results to Excel file
-        df = pd.DataFrame(results)
-        df = df[['domain', 'ip', 'port', 'attempted', 'connected', 'failed', 'packet_loss_rate', 'min_time', 'max_time', 'avg_time']]
-        df.to_excel(output_file, index=False)
-
-        # Display completion message
-        print("\033[92m" + "Results have been saved to the Excel file successfully." + "\033[0m")
+    # Paping forks a process per target, the native method only waits on sockets and runs in a single thread
+    if use_paping:
+        results = run_paping_tests(targets, attempts, interval, max_processes, total_pings)
+    else:
+        results = run_asyncio_tests(targets, attempts, interval, max_processes * PROBES_PER_PROCESS, total_pings, parallel_attempts)
+
+    # Sort results by IP address and port, handle None values
+    results.sort(key=lambda x: (x.ip if x.ip is not None else '', x.port))
+
+    # Print results
+    if print_results:
+        for result in results:
+            domain_display = result.domain if result.domain else '-'
+            print(f"{domain_display} ({result.ip}):{result.port} - Attempted = {result.attempted}, "
+                  f"Connected = {result.connected}, Failed = {result.failed}, "
+                  f"Loss = {result.packet_loss_rate:.2f}%, "
+                  f"Min = {result.min_time:.2f}ms, Max = {result.max_time:.2f}ms, "
+                  f"Avg = {result.avg_time:.2f}ms")
+
+    # Save results to Excel file, streaming the rows in constant memory
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'nan_inf_to_errors': True})
+    worksheet = workbook.add_worksheet('results')
+    worksheet.write_row(0, 0, RESULT_COLUMNS)
+    for row_index, result in enumerate(results, start=1):
+        worksheet.write_row(row_index, 0, result)
+    workbook.close()
+
+    # Display completion message
+    print("\033[92m" + "Results have been saved to the Excel file successfully." + "\033[0m")
 
 # Main function
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Batch test TCP port connectivity.")
+    parser.add_argument('--parallel-attempts', action='store_true', help="Start the attempts for each target every interval seconds without waiting for the previous one (native method only)")
+    args = parser.parse_args()
+
     filename = input("Please enter the target file name (default: targets.txt): ") or 'targets.txt'
     attempts = input("Please enter the number of attempts (default: 4): ")
     attempts = int(attempts) if attempts.isdigit() else 4
@@ -274,7 +303,7 @@ if __name__ == '__main__':
     max_processes = int(max_processes) if max_processes.isdigit() else 4
     default_ports_input = input("Please enter the default ports (comma separated, default: 80,443): ")
     default_ports = [int(port) for port in default_ports_input.split(',')] if default_ports_input else [80, 443]
-    use_paping_input = input("Do you want to use paping for testing (y/n, default: n, selecting no will use native method for testing): ").lower()
+    use_paping_input = input("Do you want to use paping for testing (deprecated) (y/n, default: n, selecting no will use native method for testing): ").lower()
     use_paping = use_paping_input in ['y', 'yes']
     if use_paping:
         paping_debug_input = input("Debug outputs (y/n, default: n): ").lower()
@@ -283,4 +312,4 @@ if __name__ == '__main__':
     print_results = print_results_input not in ['n', 'no']
     output_file = input("Please enter the output Excel file name (default: results.xlsx): ") or 'results.xlsx'
 
-    run_tests(filename, attempts, interval, max_processes, default_ports, use_paping, output_file, print_results)
+    run_tests(filename, attempts, interval, max_processes, default_ports, use_paping, output_file, print_results, args.parallel_attempts)
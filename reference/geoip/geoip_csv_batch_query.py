@@ -1,12 +1,17 @@
 #!/usr/bin/python3
 import pandas as pd
+import numpy as np
 import ipaddress
+import socket
+import struct
+import functools
 import openpyxl
+import xlsxwriter
 from tqdm import tqdm
 import threading
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
-import re
+from multiprocessing import shared_memory
 import argparse
 import gzip
 import zipfile
@@ -14,6 +19,16 @@ import csv
 import os
 import sys
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, lookups fall back to np.searchsorted
+    njit = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:  # python-isal is optional, .csv.gz files fall back to the gzip module
+    igzip_threaded = None
+
 class LoadingAnimation:
     def __init__(self):
         self.stop_event = threading.Event()
@@ -33,19 +48,222 @@ class LoadingAnimation:
                 time.sleep(0.1)
         sys.stderr.write(f"\r\033[2KLoading GeoIP data done\n")
 
+# Dotted-quad IPv4 address without leading zeros, as accepted by inet_pton
+IPV4_PATTERN = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(?:\.(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}'
+
+# Structured key used to sort and search 128-bit IPv6 addresses as two 64-bit halves
+IPV6_KEY = np.dtype([('hi', np.uint64), ('lo', np.uint64)])
+IPV6_LOW_MASK = (1 << 64) - 1
+
+# Lookup table arrays placed in shared memory, the code-to-name lists are small and pickled as is
+SHARED_TABLE_ARRAYS = ('start', 'end', 'country', 'continent', 'prefix_index')
+
+# IPv4 tables are indexed by the top PREFIX_BITS bits of the range end, a flat first level of a radix tree
+PREFIX_BITS = 16
+
+# Parsed lookup tables are cached next to the GeoIP file under this suffix
+GEOIP_CACHE_SUFFIX = '.cache.npz'
+
+# GeoIP lookup tables of a worker process, set once by init_geoip_worker
+geoip_tables = {}
+
 def load_geoip_data(geoip_file):
-    """Load GeoIP data from the CSV file into a DataFrame, and separate IPv4 and IPv6 addresses."""
-    geoip_data = read_csv_file(geoip_file)
-    geoip_data['start_ip'] = geoip_data['start_ip'].apply(ipaddress.ip_address)
-    geoip_data['end_ip'] = geoip_data['end_ip'].apply(ipaddress.ip_address)
-    ipv4_data = geoip_data[geoip_data['start_ip'].apply(lambda x: x.version) == 4]
-    ipv6_data = geoip_data[geoip_data['start_ip'].apply(lambda x: x.version) == 6]
+    """Load GeoIP data from the CSV file into sorted lookup tables, and separate IPv4 and IPv6 addresses."""
+    cache_file = geoip_file + GEOIP_CACHE_SUFFIX
+    tables = None
+    if os.path.exists(cache_file):
+        tables = load_geoip_cache(cache_file, geoip_file)
+    if tables is None:
+        geoip_data = read_csv_file(geoip_file)
+        is_ipv6 = geoip_data['start_ip'].astype(str).str.contains(':', regex=False)
+        tables = build_lookup_table(geoip_data[~is_ipv6], ipv4_series_to_keys), build_lookup_table(geoip_data[is_ipv6], ipv6_series_to_keys)
+        save_geoip_cache(cache_file, geoip_file, *tables)
+    ipv4_data, ipv6_data = tables
+    ipv4_data['prefix_index'] = build_prefix_index(ipv4_data['end'])
     return ipv4_data, ipv6_data
 
+def geoip_file_signature(geoip_file):
+    """Return the size and modification time of the GeoIP file, used to tell whether its cache is current."""
+    stat = os.stat(geoip_file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def save_geoip_cache(cache_file, geoip_file, ipv4_data, ipv6_data):
+    """Save the parsed lookup tables next to the GeoIP file, so that later runs can skip parsing the CSV."""
+    arrays = {'source': geoip_file_signature(geoip_file)}
+    for version, table in (('ipv4', ipv4_data), ('ipv6', ipv6_data)):
+        for key in ('start', 'end', 'country', 'continent'):
+            arrays[f'{version}_{key}'] = table[key]
+        # Names are stored as plain strings plus a mask of the missing ones, so the cache loads without pickle
+        for key in ('country_names', 'continent_names'):
+            names = table[key]
+            arrays[f'{version}_{key}'] = np.array([name if isinstance(name, str) else '' for name in names], dtype=str)
+            arrays[f'{version}_{key}_missing'] = np.array([not isinstance(name, str) for name in names], dtype=bool)
+    try:
+        with open(cache_file + '.tmp', 'wb') as cache:
+            np.savez(cache, **arrays)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError as e:
+        sys.stderr.write(f"\r\033[2KCould not write GeoIP cache {cache_file}: {e}\n")
+
+def load_geoip_cache(cache_file, geoip_file):
+    """Load lookup tables saved by save_geoip_cache, or return None if the cache cannot be used."""
+    try:
+        with np.load(cache_file) as cache:
+            # Any change of size or mtime means another file, even one with an older mtime than the cache
+            if not np.array_equal(cache['source'], geoip_file_signature(geoip_file)):
+                return None
+            tables = []
+            for version in ('ipv4', 'ipv6'):
+                table = {key: cache[f'{version}_{key}'] for key in ('start', 'end', 'country', 'continent')}
+                for key in ('country_names', 'continent_names'):
+                    names = cache[f'{version}_{key}'].astype(object)
+                    names[cache[f'{version}_{key}_missing']] = None
+                    table[key] = names
+                tables.append(table)
+    except (OSError, KeyError, ValueError):
+        return None
+    sys.stderr.write(f"\r\033[2KParsed GeoIP data loaded from {cache_file}\n")
+    return tuple(tables)
+
+def int_to_ipv4(value):
+    """Convert an integer to a dotted-quad IPv4 address string."""
+    return socket.inet_ntoa(struct.pack('>I', value))
+
+@functools.lru_cache(maxsize=65536)
+def summarize_ipv4_range(start, end):
+    """Summarize an IPv4 range given as integers into a comma-separated list of CIDR blocks."""
+    cidrs = []
+    while start <= end:
+        host_bits = min((start & -start).bit_length() - 1 if start else 32, (end - start + 1).bit_length() - 1)
+        cidrs.append(f"{int_to_ipv4(start)}/{32 - host_bits}")
+        start += 1 << host_bits
+    return ', '.join(cidrs)
+
+def ipv4_series_to_keys(series):
+    """Convert a Series of dotted-quad IPv4 address strings to a uint32 array."""
+    # inet_aton packs each address in C, numpy reads the joined big-endian bytes in one go
+    packed = b''.join(map(socket.inet_aton, series))
+    return np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+
+def ipv6_series_to_keys(series):
+    """Convert a Series of IPv6 address strings to an array of (hi, lo) uint64 keys."""
+    packed = b''.join(socket.inet_pton(socket.AF_INET6, ip) for ip in series)
+    return np.frombuffer(packed, dtype=[('hi', '>u8'), ('lo', '>u8')]).astype(IPV6_KEY)
+
+def ints_to_ipv6_keys(values):
+    """Convert integer IPv6 addresses to an array of (hi, lo) uint64 keys."""
+    return np.array([(value >> 64, value & IPV6_LOW_MASK) for value in values], dtype=IPV6_KEY)
+
+def build_lookup_table(data, to_keys):
+    """Build a lookup table of IP ranges sorted by end address."""
+    starts = to_keys(data['start_ip'])
+    ends = to_keys(data['end_ip'])
+    # Countries and continents are stored as integer codes into a short list of names
+    countries, country_names = pd.factorize(data['country'], use_na_sentinel=False)
+    if 'continent_name' in data.columns:
+        continents, continent_names = pd.factorize(data['continent_name'], use_na_sentinel=False)
+    else:
+        continents, continent_names = np.zeros(len(data), dtype=np.int64), [None]
+    order = np.argsort(ends, kind='stable')
+    return {
+        'start': starts[order],
+        'end': ends[order],
+        'country': countries[order],
+        'continent': continents[order],
+        'country_names': np.asarray(country_names, dtype=object),
+        'continent_names': np.asarray(continent_names, dtype=object),
+    }
+
+def share_lookup_table(table, blocks):
+    """Copy the arrays of a lookup table into shared memory and return a small picklable description of it."""
+    description = dict(table)
+    for key in SHARED_TABLE_ARRAYS:
+        if key not in table:
+            continue
+        array = table[key]
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(shm)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        description[key] = (shm.name, array.shape, array.dtype)
+    return description
+
+def attach_lookup_table(description, blocks):
+    """Rebuild a lookup table from share_lookup_table's description, using the shared arrays without copying."""
+    table = dict(description)
+    for key in SHARED_TABLE_ARRAYS:
+        if key not in description:
+            continue
+        name, shape, dtype = description[key]
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        table[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return table
+
+def build_prefix_index(ends):
+    """Return, for each IPv4 prefix p of PREFIX_BITS bits and one past the last, the first range ending at or after p."""
+    prefixes = np.arange((1 << PREFIX_BITS) + 1, dtype=np.uint64) << (32 - PREFIX_BITS)
+    return np.searchsorted(ends, prefixes, side='left').astype(np.int64)
+
+def keys_less_equal(left, right):
+    """Element-wise `left <= right` for uint32 or (hi, lo) IPv6 keys."""
+    if left.dtype.names:
+        return (left['hi'] < right['hi']) | ((left['hi'] == right['hi']) & (left['lo'] <= right['lo']))
+    return left <= right
+
+def lookup_ipv4_ranges(starts, ends, prefix_index, lows, highs):
+    """Binary search kernel for uint32 IPv4 tables, compiled with numba when it is installed."""
+    out = np.empty(highs.size, np.int64)
+    for i in range(highs.size):
+        # Only the ranges ending within the prefix of the query are searched
+        prefix = highs[i] >> (32 - PREFIX_BITS)
+        lo, hi = prefix_index[prefix], prefix_index[prefix + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ends[mid] < highs[i]:
+                lo = mid + 1
+            else:
+                hi = mid
+        out[i] = lo if lo < ends.size and starts[lo] <= lows[i] else -1
+    return out
+
+if njit is not None:
+    lookup_ipv4_ranges = njit(cache=True)(lookup_ipv4_ranges)
+
+def lookup_ranges(table, lows, highs):
+    """Return the index of the range containing each [low, high] query, or -1 if there is none."""
+    ends = table['end']
+    if len(ends) == 0:
+        return np.full(len(highs), -1, dtype=np.int64)
+    if njit is not None and not ends.dtype.names:
+        return lookup_ipv4_ranges(table['start'], ends, table['prefix_index'], lows, highs)
+    idx = np.searchsorted(ends, highs, side='left')
+    found = idx < len(ends)
+    idx = np.minimum(idx, len(ends) - 1)
+    found &= keys_less_equal(table['start'][idx], lows)
+    return np.where(found, idx, -1)
+
+def ipv6_key_to_ip(key):
+    """Convert a (hi, lo) IPv6 key back to an IP address object."""
+    return ipaddress.IPv6Address((int(key['hi']) << 64) | int(key['lo']))
+
+def ip_query_bounds(ip):
+    """Return the IP version and the integer bounds covered by an IP address or CIDR block."""
+    if '/' in ip:
+        network = ipaddress.ip_network(ip, strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+    try:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        return 4, value, value
+    except OSError:
+        ip_addr = ipaddress.ip_address(ip)
+        return ip_addr.version, int(ip_addr), int(ip_addr)
+
 def read_csv_file(file_path):
     """Read CSV file with support for gzip and zip formats."""
     if file_path.endswith('.csv.gz'):
-        with gzip.open(file_path, mode='rt', newline='', encoding='utf-8') as gzfile:
+        # ISA-L inflates in a background thread while pandas parses
+        gzip_open = igzip_threaded.open if igzip_threaded is not None else gzip.open
+        with gzip_open(file_path, 'rb') as gzfile:
             geoip_data = pd.read_csv(gzfile)
     elif file_path.endswith('.csv.zip'):
         with zipfile.ZipFile(file_path, 'r') as zipf:
@@ -73,54 +291,66 @@ def detect_format_and_load(geoip_data):
     
     return geoip_data
 
-def find_country_continent_cidr(ip_series, ipv4_data, ipv6_data, start_index, progress_bar, is_text_file=False):
+def find_country_continent_cidr(ip_series, ipv4_data, ipv6_data, start_index, is_text_file=False):
     """Find country, continent, and CIDR for each IP address or CIDR block in the series."""
-    countries, continents, cidrs, errors = [], [], [], []
-
-    for i, ip in enumerate(ip_series):
+    # Repeated entries are parsed and looked up once, the results are spread back over the rows afterwards
+    codes, unique_ips = pd.factorize(ip_series)
+    unique_series = pd.Series(unique_ips, dtype=object)
+    count = len(unique_series)
+    countries, continents, cidrs = np.full(count, None, dtype=object), np.full(count, None, dtype=object), np.full(count, None, dtype=object)
+    parse_errors = [None] * count
+    unmatched = np.zeros(count, dtype=bool)
+    queries = {4: ([], [], []), 6: ([], [], [])}  # positions, lows, highs
+
+    # Plain IPv4 addresses are converted all at once, CIDR blocks, IPv6 and invalid entries one by one
+    is_plain_ipv4 = unique_series.str.fullmatch(IPV4_PATTERN).to_numpy(dtype=bool)
+    ipv4_positions = np.flatnonzero(is_plain_ipv4)
+    ipv4_keys = ipv4_series_to_keys(unique_series[is_plain_ipv4])
+
+    for i in np.flatnonzero(~is_plain_ipv4):
         try:
-            # Handle CIDR blocks
-            if '/' in ip:
-                network = ipaddress.ip_network(ip, strict=False)
-                if network.version == 4:
-                    match = ipv4_data[(ipv4_data['start_ip'] <= network.network_address) &
-                                      (ipv4_data['end_ip'] >= network.broadcast_address)]
-                else:
-                    match = ipv6_data[(ipv6_data['start_ip'] <= network.network_address) &
-                                      (ipv6_data['end_ip'] >= network.broadcast_address)]
-            else:
-                ip_addr = ipaddress.ip_address(ip)
-                if ip_addr.version == 4:
-                    match = ipv4_data[(ipv4_data['start_ip'] <= ip_addr) &
-                                      (ipv4_data['end_ip'] >= ip_addr)]
-                else:
-                    match = ipv6_data[(ipv6_data['start_ip'] <= ip_addr) &
-                                      (ipv6_data['end_ip'] >= ip_addr)]
-            
-            if not match.empty:
-                row = match.iloc[0]
-                start_ip, end_ip = row['start_ip'], row['end_ip']
-                network = ipaddress.summarize_address_range(start_ip, end_ip)
-                cidr = ', '.join(str(net) for net in network)
-                countries.append(row['country'])
-                continents.append(row['continent_name'])
-                cidrs.append(cidr)
-            else:
-                countries.append(None)
-                continents.append(None)
-                cidrs.append(None)
-                errors.append(f"No match found for IP/CIDR '{ip}'")
+            version, low, high = ip_query_bounds(unique_series.iloc[i])
+            positions, lows, highs = queries[version]
+            positions.append(i)
+            lows.append(low)
+            highs.append(high)
         except ValueError as e:
+            parse_errors[i] = e
+
+    for version, table in ((4, ipv4_data), (6, ipv6_data)):
+        positions, lows, highs = queries[version]
+        if version == 4:
+            positions = np.concatenate([ipv4_positions, np.array(positions, dtype=np.int64)])
+            lows = np.concatenate([ipv4_keys, np.array(lows, dtype=np.uint32)])
+            highs = np.concatenate([ipv4_keys, np.array(highs, dtype=np.uint32)])
+        else:
+            lows, highs = ints_to_ipv6_keys(lows), ints_to_ipv6_keys(highs)
+        if not len(positions):
+            continue
+
+        for i, row in zip(positions, lookup_ranges(table, lows, highs)):
+            if row < 0:
+                unmatched[i] = True
+                continue
+            if version == 4:
+                cidrs[i] = summarize_ipv4_range(int(table['start'][row]), int(table['end'][row]))
+            else:
+                network = ipaddress.summarize_address_range(ipv6_key_to_ip(table['start'][row]), ipv6_key_to_ip(table['end'][row]))
+                cidrs[i] = ', '.join(str(net) for net in network)
+            countries[i] = table['country_names'][table['country'][row]]
+            continents[i] = table['continent_names'][table['continent'][row]]
+
+    # Errors are reported for every row, since parse errors carry the row number
+    has_error = unmatched | np.array([error is not None for error in parse_errors], dtype=bool)
+    errors = []
+    for i in np.flatnonzero(has_error[codes]):
+        ip = unique_series.iloc[codes[i]]
+        if unmatched[codes[i]]:
+            errors.append(f"No match found for IP/CIDR '{ip}'")
+        else:
             row_number = start_index + i + 1 if is_text_file else start_index + i + 2  # Adjust for zero-based index and header row
-            errors.append(f"[Skipped] Error processing IP '{ip}' at row {row_number}: {e}")
-            countries.append(None)
-            continents.append(None)
-            cidrs.append(None)
-        
-        # Update progress bar
-        progress_bar.update(1)
-    
-    return countries, continents, cidrs, errors
+            errors.append(f"[Skipped] Error processing IP '{ip}' at row {row_number}: {parse_errors[codes[i]]}")
+    return countries[codes], continents[codes], cidrs[codes], errors
 
 def column_letter_to_index(letter):
     """Convert Excel column letter to zero-based column index."""
@@ -130,32 +360,105 @@ def column_letter_to_index(letter):
         index = index * 26 + (ord(char) - ord('A')) + 1
     return index - 1
 
-def process_chunk(chunk, ipv4_data, ipv6_data, start_index, position, is_text_file=False):
-    """Process a chunk of the DataFrame."""
-    ip_series = chunk['IP']
-    description = f"Processing IPs in chunk starting at {'line' if is_text_file else 'row'} {start_index + 1}"
-    with tqdm(total=len(ip_series), desc=description, position=position) as progress_bar:
-        countries, continents, cidrs, errors = find_country_continent_cidr(ip_series, ipv4_data, ipv6_data, start_index, progress_bar, is_text_file)
-    chunk['Country'] = countries
-    chunk['Continent'] = continents
-    chunk['CIDR'] = cidrs
-    chunk['OriginalIndex'] = chunk.index  # Add original index
-    return chunk, errors
+def init_geoip_worker(ipv4_description, ipv6_description):
+    """Attach a worker process to the shared GeoIP lookup tables once, instead of sending them with every chunk."""
+    blocks = geoip_tables.setdefault('blocks', [])
+    geoip_tables['ipv4'] = attach_lookup_table(ipv4_description, blocks)
+    geoip_tables['ipv6'] = attach_lookup_table(ipv6_description, blocks)
+
+def process_chunk(ips, start_index, is_text_file=False):
+    """Process a chunk of IP addresses, returning its result columns as arrays along with its start index."""
+    ipv4_data, ipv6_data = geoip_tables['ipv4'], geoip_tables['ipv6']
+    countries, continents, cidrs, errors = find_country_continent_cidr(pd.Series(ips, dtype=object), ipv4_data, ipv6_data, start_index, is_text_file)
+    return start_index, countries, continents, cidrs, errors
+
+def process_ips(df, ipv4_data, ipv6_data, chunk_size, is_text_file=False):
+    """Add country, continent, and CIDR columns for the IP column of the DataFrame, and return the errors."""
+    ips = df['IP'].to_numpy(dtype=object)
+    columns = {name: np.full(len(df), None, dtype=object) for name in ('Country', 'Continent', 'CIDR')}
+    all_errors = []
+
+    # Every worker runs init_geoip_worker once, so no more workers are started than there are chunks
+    starts = range(0, len(ips), chunk_size)
+    max_workers = max(1, min(os.cpu_count() or 1, len(starts)))
+
+    shared_blocks = []
+    try:
+        initargs = (share_lookup_table(ipv4_data, shared_blocks), share_lookup_table(ipv6_data, shared_blocks))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_geoip_worker, initargs=initargs) as executor:
+            # Only the IP column is sent to the workers, and only the result columns come back
+            futures = [executor.submit(process_chunk, ips[i:i + chunk_size], i, is_text_file) for i in starts]
+            # Progress is reported here as chunks complete, the workers do not update any progress bar
+            with tqdm(total=len(df), desc="Processing IPs") as progress_bar:
+                for future in as_completed(futures):
+                    start_index, countries, continents, cidrs, chunk_errors = future.result()
+                    end_index = start_index + len(countries)
+                    columns['Country'][start_index:end_index] = countries
+                    columns['Continent'][start_index:end_index] = continents
+                    columns['CIDR'][start_index:end_index] = cidrs
+                    all_errors.extend(chunk_errors)
+                    progress_bar.update(len(countries))
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    for name, values in columns.items():
+        df[name] = values
+    return all_errors
+
+def output_rows(dataframe, format_dates=False):
+    """Iterate over the rows of the DataFrame as tuples, with missing values as None."""
+    columns = []
+    for i in range(dataframe.shape[1]):
+        column = dataframe.iloc[:, i]
+        if format_dates and pd.api.types.is_datetime64_any_dtype(column):
+            # Formatted like to_csv does it, with the time left out when no value in the column has one.
+            # The mask comes from the datetime column, pandas 2 formats NaT as the string 'NaT'
+            column = column.astype(str).where(column.notna())
+        values = column.to_numpy(dtype=object)
+        values[pd.isna(values)] = None
+        columns.append(values)
+    return zip(*columns)
 
 def save_output(dataframe, output_file, file_format):
     """Save the processed DataFrame to the specified file format."""
     if file_format == 'excel':
-        dataframe.to_excel(output_file, index=False, engine='openpyxl')
+        # Stream rows with xlsxwriter's constant memory mode, pandas writes cells column by column which it does not support
+        # Date cells get the same format as DataFrame.to_excel gives them, instead of showing as serial numbers
+        workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+        worksheet = workbook.add_worksheet('results')
+        worksheet.write_row(0, 0, dataframe.columns)
+        for row_index, row in enumerate(output_rows(dataframe), start=1):
+            worksheet.write_row(row_index, 0, row)
+        workbook.close()
     elif file_format == 'csv':
-        dataframe.to_csv(output_file, index=False)
+        # csv.writer on the column arrays skips the per-cell formatting of DataFrame.to_csv
+        with open(output_file, 'w', newline='', encoding='utf-8', buffering=1 << 20) as outfile:
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(dataframe.columns)
+            writer.writerows(output_rows(dataframe, format_dates=True))
+
+def read_excel_rows(input_excel):
+    """Read the active worksheet into a DataFrame using openpyxl's streaming read-only mode."""
+    workbook = openpyxl.load_workbook(input_excel, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+        data = list(rows)
+    finally:
+        workbook.close()
+    # Like pd.read_excel, blank rows inside the sheet are kept and only trailing ones are dropped
+    while data and all(value is None for value in data[-1]):
+        data.pop()
+    columns = [f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)]
+    return pd.DataFrame(data, columns=columns)
 
 def process_excel(input_excel, output_file, ip_column_letter, geoip_file, chunk_size, file_format):
     """Process the Excel file, add country, continent, and CIDR columns."""
-    df = pd.read_excel(input_excel, engine='openpyxl')
-
     ip_column_index = column_letter_to_index(ip_column_letter)
-    ip_column = df.columns[ip_column_index]
-    df.rename(columns={ip_column: 'IP'}, inplace=True)
+    df = read_excel_rows(input_excel)
+    df.columns = ['IP' if i == ip_column_index else column for i, column in enumerate(df.columns)]
 
     animation = LoadingAnimation()
     animation.start()
@@ -166,18 +469,9 @@ def process_excel(input_excel, output_file, ip_column_letter, geoip_file, chunk_
 
     df['IP'] = df['IP'].astype(str)
 
-    chunks = [df.iloc[i:i + chunk_size] for i in range(0, df.shape[0], chunk_size)]
-    results, all_errors = [], []
+    all_errors = process_ips(df, ipv4_data, ipv6_data, chunk_size)
 
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(process_chunk, chunk, ipv4_data, ipv6_data, chunk.index.start, position) for position, chunk in enumerate(chunks)]
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing chunks"):
-            chunk_result, chunk_errors = future.result()
-            results.append(chunk_result)
-            all_errors.extend(chunk_errors)
-
-    processed_df = pd.concat(results).sort_values(by='OriginalIndex').drop(columns=['OriginalIndex'])
-    processed_df = processed_df.dropna(subset=['Country'])
+    processed_df = df.dropna(subset=['Country'])
     save_output(processed_df, output_file, file_format)
 
     if all_errors:
@@ -189,14 +483,18 @@ def process_excel(input_excel, output_file, ip_column_letter, geoip_file, chunk_
     sys.stderr.write("-" * 80)
     print(f"Processed data has been written to {output_file}")
 
+def read_text_ips(text_file):
+    """Read the first field of each line of a text file, ignoring comments and anything after ':' or whitespace."""
+    try:
+        df = pd.read_csv(text_file, sep=r'[:\s]+', engine='python', comment='#', header=None, names=['IP'],
+                         usecols=[0], dtype=str, quoting=csv.QUOTE_NONE)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=['IP'])
+    return df.dropna().reset_index(drop=True)
+
 def process_text_file(text_file, output_file, geoip_file, chunk_size, file_format):
     """Process a text file with IP addresses, add country, continent, and CIDR columns."""
-    with open(text_file, 'r') as file:
-        lines = file.readlines()
-    
-    ip_addresses = [re.split(r'[:\s]', re.sub(r'#.*', '', line).strip())[0] for line in lines if re.split(r'[:\s]', re.sub(r'#.*', '', line).strip())[0]]
-
-    df = pd.DataFrame(ip_addresses, columns=['IP'])
+    df = read_text_ips(text_file)
 
     animation = LoadingAnimation()
     animation.start()
@@ -207,18 +505,9 @@ def process_text_file(text_file, output_file, geoip_file, chunk_size, file_forma
 
     df['IP'] = df['IP'].astype(str)
 
-    chunks = [df.iloc[i:i + chunk_size] for i in range(0, df.shape[0], chunk_size)]
-    results, all_errors = [], []
-
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(process_chunk, chunk, ipv4_data, ipv6_data, chunk.index.start, position, True) for position, chunk in enumerate(chunks)]
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing chunks"):
-            chunk_result, chunk_errors = future.result()
-            results.append(chunk_result)
-            all_errors.extend(chunk_errors)
+    all_errors = process_ips(df, ipv4_data, ipv6_data, chunk_size, True)
 
-    processed_df = pd.concat(results).sort_values(by='OriginalIndex').drop(columns=['OriginalIndex'])
-    processed_df = processed_df.dropna(subset=['Country'])
+    processed_df = df.dropna(subset=['Country'])
     save_output(processed_df, output_file, file_format)
 
     if all_errors:
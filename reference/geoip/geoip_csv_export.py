@@ -1,81 +1,185 @@
 #!/usr/bin/python3
-import csv
 import ipaddress
 import pandas as pd
+import numpy as np
 import os
+import socket
 import argparse
-import gzip
 import zipfile
+import xlsxwriter
 import sys
 
-def ip_range_to_cidr(start_ip, end_ip):
-    """Convert an IP range to CIDR format."""
-    start_ip = ipaddress.ip_address(start_ip)
-    end_ip = ipaddress.ip_address(end_ip)
-    return [str(cidr) for cidr in ipaddress.summarize_address_range(start_ip, end_ip)]
-
-def filter_and_convert_to_cidr(input_file, output_path, continent_codes=None, country_codes=None, ip_version=None, output_format='txt', separate_countries=False, separate_ip_versions=False, reverse=False):
-    """Filter IP ranges by continent or country and convert to CIDR format."""
-    with open(input_file, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        filtered_cidrs = []
-
-        for row in reader:
-            row_continent = row['continent'].upper()
-            row_country = row['country'].upper()
-
-            matches_continent = continent_codes and row_continent in continent_codes
-            matches_country = country_codes and row_country in country_codes
-
-            matches = not (matches_continent or matches_country) if reverse else (matches_continent or matches_country)
-
-            if matches or (not continent_codes and not country_codes):
-                start_ip = row['start_ip']
-                end_ip = row['end_ip']
-
-                if (ip_version is None) or (ip_version == 4 and ':' not in start_ip) or (ip_version == 6 and ':' in start_ip):
-                    cidrs = ip_range_to_cidr(start_ip, end_ip)
-                    for cidr in cidrs:
-                        filtered_cidrs.append({
-                            'CIDR': cidr,
-                            'Country': row['country'],
-                            'Continent': row['continent'],
-                            'IP_Version': 'IPv4' if ':' not in start_ip else 'IPv6'
-                        })
-
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, summarize_all falls back to summarize_v4
+    njit = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:  # python-isal is optional, pandas decompresses .csv.gz files itself
+    igzip_threaded = None
+
+# Number of CSV rows read per pandas chunk
+CSV_CHUNK_SIZE = 200_000
+
+def summarize_v4(start, end):
+    """Split an IPv4 range given as integers into (network, host_bits) blocks."""
+    blocks = []
+    while start <= end:
+        host_bits = min((start & -start).bit_length() - 1 if start else 32, (end - start + 1).bit_length() - 1)
+        blocks.append((start, host_bits))
+        start += 1 << host_bits
+    return blocks
+
+def summarize_all(starts, ends):
+    """Summarize arrays of IPv4 ranges into flat (networks, host_bits) arrays, range i owning offsets[i]:offsets[i + 1]."""
+    blocks = [summarize_v4(int(start), int(end)) for start, end in zip(starts, ends)]
+    offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(range_blocks) for range_blocks in blocks])
+    flat = [block for range_blocks in blocks for block in range_blocks]
+    networks = np.array([network for network, _ in flat], dtype=np.uint32)
+    host_bits = np.array([bits for _, bits in flat], dtype=np.uint8)
+    return networks, host_bits, offsets
+
+if njit is not None:
+    @njit(cache=True)
+    def block_host_bits(start, end):
+        """Host bits of the largest CIDR block that starts at start and ends at or before end."""
+        bits = 0
+        while bits < 32 and (start >> bits) & 1 == 0 and start + (2 << bits) - 1 <= end:
+            bits += 1
+        return bits
+
+    @njit(cache=True, parallel=True)
+    def summarize_all(starts, ends):
+        """Summarize arrays of IPv4 ranges into flat (networks, host_bits) arrays, range i owning offsets[i]:offsets[i + 1]."""
+        n = starts.size
+        counts = np.zeros(n, np.int64)
+        for i in prange(n):
+            start, end = np.int64(starts[i]), np.int64(ends[i])
+            while start <= end:
+                start += np.int64(1) << block_host_bits(start, end)
+                counts[i] += 1
+        offsets = np.zeros(n + 1, np.int64)
+        offsets[1:] = np.cumsum(counts)
+        networks = np.empty(offsets[n], np.uint32)
+        host_bits = np.empty(offsets[n], np.uint8)
+        for i in prange(n):
+            start, end = np.int64(starts[i]), np.int64(ends[i])
+            k = offsets[i]
+            while start <= end:
+                bits = block_host_bits(start, end)
+                networks[k] = start
+                host_bits[k] = bits
+                start += np.int64(1) << bits
+                k += 1
+        return networks, host_bits, offsets
+
+def merge_v4_ranges(pool):
+    """Sort an (n, 2) array of IPv4 (start, end) ranges and merge the ones that overlap or touch."""
+    pool = pool[np.argsort(pool[:, 0], kind='stable')]
+    starts, ends = pool[:, 0].astype(np.int64), pool[:, 1].astype(np.int64)
+    # A range starts a new merged range unless it begins at or before one past the furthest end so far
+    first = np.ones(len(pool), dtype=bool)
+    first[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1] + 1
+    first_positions = np.flatnonzero(first)
+    return np.column_stack([starts[first_positions], np.maximum.reduceat(ends, first_positions)]).astype(np.uint32)
+
+def merge_v6_ranges(pool):
+    """Sort packed IPv6 (start, end) ranges and merge the ones that overlap or touch, as integer pairs."""
+    merged = []
+    for start, end in sorted((int.from_bytes(start, 'big'), int.from_bytes(end, 'big')) for start, end in pool):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def format_v4_cidrs(networks, host_bits):
+    """Format arrays of IPv4 blocks from summarize_all as CIDR lines, each ending with a newline."""
+    fields = np.column_stack([networks >> 24, networks >> 16 & 0xff, networks >> 8 & 0xff, networks & 0xff, 32 - host_bits.astype(np.uint32)])
+    # A single % over all fields formats every line in C, without a Python call per CIDR
+    return ('%d.%d.%d.%d/%d\n' * len(networks)) % tuple(fields.ravel().tolist())
+
+def filter_and_convert_to_cidr(country_data, output_path, continent_codes=None, country_codes=None, ip_version=None, output_format='txt', separate_countries=False, separate_ip_versions=False, reverse=False):
+    """Filter the collected IP ranges by continent or country and convert them to CIDR format."""
+    # CIDRs are generated one country and IP version at a time and written out straight away
+    batches = filtered_cidr_batches(country_data, continent_codes, country_codes, ip_version, reverse)
     if output_format == 'txt':
-        save_to_text(filtered_cidrs, output_path, separate_countries, separate_ip_versions)
+        save_to_text(batches, output_path, separate_countries, separate_ip_versions)
     elif output_format == 'excel':
-        df = pd.DataFrame(filtered_cidrs)
-        df.to_excel(output_path, index=False)
-
-def save_to_text(filtered_cidrs, output_path, separate_countries, separate_ip_versions):
-    if separate_countries or separate_ip_versions:
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-
-        country_files = {}
-        for entry in filtered_cidrs:
-            country = entry['Country']
-            ip_version = entry['IP_Version']
-            filename = os.path.join(output_path, f"{country}_{ip_version}.txt".lower()) if separate_countries and separate_ip_versions else \
-                       os.path.join(output_path, f"{country}.txt".lower()) if separate_countries else \
-                       os.path.join(output_path, f"{ip_version}.txt".lower()) if separate_ip_versions else \
-                       os.path.join(output_path, "output_cidrs.txt".lower())
-
-            if filename not in country_files:
-                country_files[filename] = []
-
-            country_files[filename].append(entry['CIDR'])
+        save_to_excel(batches, output_path)
+
+def filtered_cidr_batches(country_data, continent_codes, country_codes, ip_version, reverse):
+    """Yield (country, continent, ip_version_label, cidr_lines) for each country and IP version passing the filters."""
+    # Country and continent codes are upper-cased by collect, so the matching countries are known up front
+    allowed = None
+    if continent_codes or country_codes:
+        allowed = frozenset(code for code, c in country_data.items()
+                            if code in (country_codes or ()) or c['continent'] in (continent_codes or ()))
+
+    for country_code, c in country_data.items():
+        if allowed is not None and (country_code in allowed) == reverse:
+            continue
 
-        for filename, cidrs in country_files.items():
-            with open(filename, 'w') as outfile:
-                for cidr in cidrs:
-                    outfile.write(f"{cidr}\n")
-    else:
-        with open(output_path.lower(), 'w') as outfile:
-            for entry in filtered_cidrs:
-                outfile.write(f"{entry['CIDR']}\n")
+        # Touching ranges of a country are merged first, so that they summarize to the fewest CIDRs
+        if ip_version != 6 and len(c['pool_v4']):
+            # Summarize all IPv4 ranges of the country at once, IPv6 ranges one by one
+            pool_v4 = merge_v4_ranges(c['pool_v4'])
+            networks, host_bits, _ = summarize_all(pool_v4[:, 0], pool_v4[:, 1])
+            yield country_code, c['continent'], 'IPv4', format_v4_cidrs(networks, host_bits)
+        if ip_version != 4 and c['pool_v6']:
+            yield country_code, c['continent'], 'IPv6', ''.join(
+                f"{cidr}\n"
+                for start_ip, end_ip in merge_v6_ranges(c['pool_v6'])
+                for cidr in ipaddress.summarize_address_range(ipaddress.IPv6Address(start_ip), ipaddress.IPv6Address(end_ip))
+            )
+
+def save_to_text(batches, output_path, separate_countries, separate_ip_versions):
+    separate = separate_countries or separate_ip_versions
+    if separate and not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    # The single output file and the per-IP-version files (at most 2) stay open for the whole run.
+    # filtered_cidr_batches yields the batches of a country one after another, so only the
+    # current country file is kept open and it is closed as soon as the next country starts.
+    writers = {}
+    country_filename = country_writer = None
+    try:
+        if not separate:
+            writers[output_path.lower()] = open(output_path.lower(), 'wb', buffering=1 << 20)
+        for country, _, ip_version, cidr_lines in batches:
+            if separate_countries:
+                filename = os.path.join(output_path, f"{country}_{ip_version}.txt".lower()) if separate_ip_versions else \
+                           os.path.join(output_path, f"{country}.txt".lower())
+                if filename != country_filename:
+                    if country_writer is not None:
+                        country_writer.close()
+                    country_writer = open(filename, 'wb', buffering=1 << 20)
+                    country_filename = filename
+                country_writer.write(cidr_lines.encode('ascii'))
+            else:
+                filename = os.path.join(output_path, f"{ip_version}.txt".lower()) if separate_ip_versions else output_path.lower()
+                if filename not in writers:
+                    writers[filename] = open(filename, 'wb', buffering=1 << 20)
+                writers[filename].write(cidr_lines.encode('ascii'))
+    finally:
+        if country_writer is not None:
+            country_writer.close()
+        for writer in writers.values():
+            writer.close()
+
+def save_to_excel(batches, output_path):
+    # Rows are streamed with xlsxwriter's constant memory mode instead of building a DataFrame first
+    workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, ['CIDR', 'Country', 'Continent', 'IP_Version'])
+    row_index = 1
+    for country, continent, ip_version, cidr_lines in batches:
+        for cidr in cidr_lines.splitlines():
+            worksheet.write_row(row_index, 0, [cidr, country, continent, ip_version])
+            row_index += 1
+    workbook.close()
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Filter IP ranges and convert to CIDR format.")
@@ -96,17 +200,15 @@ def parse_arguments():
     
     return parser.parse_args()
 
-def detect_format_and_collect(csv_file, ignore_first_row, start_ip_col, end_ip_col, country_code_col, existing_country_data):
-    country = existing_country_data
-    
-    first_row = next(csv_file)
-
+def detect_format(first_row, ignore_first_row, start_ip_col, end_ip_col, country_code_col):
+    continent_col = None
     if first_row == ['start_ip', 'end_ip', 'country', 'country_name', 'continent', 'continent_name']:
         sys.stdout.write("ipinfo.io country.csv format matched!\n")
         ignore_first_row = True
         start_ip_col = 0
         end_ip_col = 1
         country_code_col = 2
+        continent_col = 4
     elif len(first_row) == 3 and all('.' in field for field in first_row[:2]):
         sys.stdout.write("dbip-country-lite format matched!\n")
         start_ip_col = 0
@@ -118,68 +220,131 @@ def detect_format_and_collect(csv_file, ignore_first_row, start_ip_col, end_ip_c
         start_ip_col = 1
         end_ip_col = 2
         country_code_col = 4
+        continent_col = 3
 
-    if not ignore_first_row:
-        csv_file = iter([first_row] + list(csv_file))
-
-    return collect(csv_file, start_ip_col, end_ip_col, country_code_col, country)
+    return ignore_first_row, start_ip_col, end_ip_col, country_code_col, continent_col
 
-def collect(csv_file, start_ip_col, end_ip_col, country_code_col, existing_country_data):
+def detect_format_and_collect(chunks, ignore_first_row, start_ip_col, end_ip_col, country_code_col, existing_country_data, filters=None):
     country = existing_country_data
-    line_num = 1
-
-    for row in csv_file:
-        line_num += 1
+    continent_col = None
+    total = 0
+
+    for chunk_index, rows in enumerate(chunks):
+        if chunk_index == 0:
+            # The format is detected from the first row of the file, the later chunks share its columns
+            if rows.empty:
+                return country
+            ignore_first_row, start_ip_col, end_ip_col, country_code_col, continent_col = detect_format(rows.iloc[0].tolist(), ignore_first_row, start_ip_col, end_ip_col, country_code_col)
+            if ignore_first_row:
+                rows = rows.iloc[1:]
+        total += collect(rows, start_ip_col, end_ip_col, country_code_col, continent_col, country, filters)
+
+    sys.stderr.write(f"\r\033[2K{total} entries total\n")
+    return country
 
-        if len(row) <= max(start_ip_col, end_ip_col, country_code_col):
-            sys.stderr.write(f"\nError: Skipping row {line_num}: insufficient columns\n")
-            continue
+def ipv4_series_to_ints(series):
+    """Convert a Series of dotted-quad IPv4 address strings to a uint32 array."""
+    # inet_aton packs each address in C, numpy reads the joined big-endian bytes in one go
+    packed = b''.join(map(socket.inet_aton, series))
+    return np.frombuffer(packed, dtype='>u4').astype(np.uint32)
 
-        start_ip, end_ip, country_code = row[start_ip_col], row[end_ip_col], row[country_code_col]
+def collect(rows, start_ip_col, end_ip_col, country_code_col, continent_col, existing_country_data, filters=None):
+    country = existing_country_data
+    columns = [start_ip_col, end_ip_col, country_code_col]
+    names = ['start_ip', 'end_ip', 'country_code']
+
+    if rows.shape[1] <= max(columns):
+        sys.stderr.write(f"\nError: Skipping all {len(rows)} rows: insufficient columns\n")
+        return 0
+    if continent_col is not None and continent_col < rows.shape[1]:
+        columns.append(continent_col)
+        names.append('continent')
+
+    rows = rows[columns].set_axis(names, axis=1)
+    # Rows shorter than the first one are padded with '', so they cannot be told apart from empty fields
+    complete = (rows[names[:3]].notna() & (rows[names[:3]] != '')).all(axis=1)
+    for line_num in rows.index[~complete] + 1:
+        sys.stderr.write(f"\nError: Skipping row {line_num}: missing or empty start IP, end IP or country code\n")
+    rows = rows[complete]
+    for name in names[2:]:
+        rows[name] = rows[name].str.upper()
+    total = len(rows)
+
+    # Rows outside the (continent_codes, country_codes, reverse) filters are dropped before their addresses are parsed
+    if filters is not None and (filters[0] or filters[1]):
+        continent_codes, country_codes, reverse = filters
+        mask = rows['country_code'].isin(country_codes or ())
+        if 'continent' in rows:
+            mask |= rows['continent'].isin(continent_codes or ())
+        rows = rows[mask != reverse]
+
+    is_v6 = rows['start_ip'].str.contains(':', regex=False)
+    v4_rows = rows[~is_v6]
+    v4_pool = np.column_stack([ipv4_series_to_ints(v4_rows['start_ip']), ipv4_series_to_ints(v4_rows['end_ip'])])
+    v6_rows = rows[is_v6]
+
+    # Country buckets are looked up once per country and chunk, not once per row
+    first_rows = rows.drop_duplicates('country_code')
+    first_continents = first_rows['continent'] if 'continent' in first_rows else [None] * len(first_rows)
+    for country_code, continent in zip(first_rows['country_code'], first_continents):
         if country_code not in country:
+            country_code = sys.intern(country_code)
             country[country_code] = {
                 'name': country_code,
-                'pool_v4': [],
+                'continent': continent or None,
+                'pool_v4': np.empty((0, 2), dtype=np.uint32),
                 'pool_v6': []
             }
+    for country_code, positions in v4_rows.groupby('country_code', sort=False).indices.items():
         c = country[country_code]
-        if ':' in start_ip:
-            c['pool_v6'].append((ipaddress.IPv6Address(start_ip).packed, ipaddress.IPv6Address(end_ip).packed))
-        else:
-            c['pool_v4'].append((int(ipaddress.IPv4Address(start_ip)), int(ipaddress.IPv4Address(end_ip))))
-
-        if line_num % 4096 == 0:
-            sys.stderr.write(f"\r\033[2K{line_num} entries")
-    sys.stderr.write(f"\r\033[2K{line_num} entries total\n")
-    return country
-
-def read_csv_file(file_path, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data):
-    if file_path.endswith('.csv.gz'):
-        with gzip.open(file_path, mode='rt', newline='', encoding='utf-8') as gzfile:
-            csvreader = csv.reader(gzfile, delimiter=',', quotechar='"')
-            country_data = detect_format_and_collect(csvreader, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data)
-    elif file_path.endswith('.csv.zip'):
+        c['pool_v4'] = np.concatenate([c['pool_v4'], v4_pool[positions]])
+    v6_starts, v6_ends = v6_rows['start_ip'].to_numpy(), v6_rows['end_ip'].to_numpy()
+    for country_code, positions in v6_rows.groupby('country_code', sort=False).indices.items():
+        country[country_code]['pool_v6'].extend(
+            (socket.inet_pton(socket.AF_INET6, v6_starts[i]), socket.inet_pton(socket.AF_INET6, v6_ends[i])) for i in positions
+        )
+
+    return total
+
+def csv_width(source):
+    """Number of fields in the first row of a CSV file."""
+    return pd.read_csv(source, header=None, nrows=1, dtype=str, compression='infer').shape[1]
+
+def read_csv_chunks(source, width):
+    """Read a headerless CSV file in chunks, each row padded to the width of the first one."""
+    # Without names each chunk would take its width from its own first row and reject longer rows after it
+    return pd.read_csv(source, header=None, names=range(width), dtype=str, keep_default_na=False, compression='infer', chunksize=CSV_CHUNK_SIZE)
+
+def read_csv_file(file_path, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data, filters=None):
+    if file_path.endswith('.csv.zip'):
         with zipfile.ZipFile(file_path, 'r') as zipf:
             for file_name in zipf.namelist():
                 if file_name.endswith('.csv'):
                     with zipf.open(file_name) as csvfile:
-                        csvreader = csv.reader(csvfile.read().decode('utf-8').splitlines(), delimiter=',', quotechar='"')
-                        country_data = detect_format_and_collect(csvreader, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data)
+                        width = csv_width(csvfile)
+                    with zipf.open(file_name) as csvfile, read_csv_chunks(csvfile, width) as chunks:
+                        country_data = detect_format_and_collect(chunks, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data, filters)
+    elif file_path.endswith('.csv.gz') and igzip_threaded is not None:
+        # ISA-L inflates in a background thread while pandas parses
+        with igzip_threaded.open(file_path, 'rb') as gzfile:
+            width = csv_width(gzfile)
+        with igzip_threaded.open(file_path, 'rb') as gzfile, read_csv_chunks(gzfile, width) as chunks:
+            country_data = detect_format_and_collect(chunks, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data, filters)
     else:
-        with open(file_path, newline='', encoding='utf-8') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            country_data = detect_format_and_collect(csvreader, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data)
+        # pandas decompresses .csv.gz inputs by itself
+        with read_csv_chunks(file_path, csv_width(file_path)) as chunks:
+            country_data = detect_format_and_collect(chunks, ignore_first_row, start_ip_col, end_ip_col, country_code_col, country_data, filters)
     return country_data
 
 def interactive_input():
     input_file = input("Enter the path to the input CSV file: ")
     continent_code_input = input("Enter the continent codes (e.g., AS, EU) or leave blank to specify countries or all: ")
-    continent_codes = [code.strip().upper() for code in continent_code_input.split(',')] if continent_code_input else None
+    continent_codes = frozenset(code.strip().upper() for code in continent_code_input.split(',')) if continent_code_input else None
     
     country_codes = None
     if not continent_codes:
         country_code_input = input("Enter the country codes (e.g., CN, US) or leave blank for all: ")
-        country_codes = [code.strip().upper() for code in country_code_input.split(',')] if country_code_input else None
+        country_codes = frozenset(code.strip().upper() for code in country_code_input.split(',')) if country_code_input else None
     
     ip_version_input = input("Enter IP version (4 for IPv4, 6 for IPv6, leave blank for both): ").strip()
     ip_version = int(ip_version_input) if ip_version_input in ['4', '6'] else None
@@ -208,16 +373,12 @@ def interactive_input():
 def main():
     args = parse_arguments()
     
-    country_data = {}
-    for csv_file in args.csv_files:
-        country_data = read_csv_file(csv_file, args.ignore_first_row, args.start_ip_col, args.end_ip_col, args.country_code_col, country_data)
-    
     if not args.output_path:
         input_file, output_path, continent_codes, country_codes, ip_version, output_format, separate_countries, separate_ip_versions, reverse = interactive_input()
     else:
         input_file = args.input_file
-        continent_codes = [code.strip().upper() for code in args.continent_codes.split(',')] if args.continent_codes else None
-        country_codes = [code.strip().upper() for code in args.country_codes.split(',')] if args.country_codes else None
+        continent_codes = frozenset(code.strip().upper() for code in args.continent_codes.split(',')) if args.continent_codes else None
+        country_codes = frozenset(code.strip().upper() for code in args.country_codes.split(',')) if args.country_codes else None
         ip_version = args.ip_version
         output_format = args.output_format
         separate_countries = args.separate_countries
@@ -227,7 +388,13 @@ def main():
         if (separate_countries or separate_ip_versions) and not os.path.exists(output_path):
             os.makedirs(output_path)
 
-    filter_and_convert_to_cidr(input_file, output_path, continent_codes, country_codes, ip_version, output_format, separate_countries, separate_ip_versions, reverse)
+    # The input is read once, the CIDRs are generated from the collected ranges
+    country_data = {}
+    filters = (continent_codes, country_codes, reverse)
+    for csv_file in args.csv_files or [input_file]:
+        country_data = read_csv_file(csv_file, args.ignore_first_row, args.start_ip_col, args.end_ip_col, args.country_code_col, country_data, filters)
+
+    filter_and_convert_to_cidr(country_data, output_path, continent_codes, country_codes, ip_version, output_format, separate_countries, separate_ip_versions, reverse)
     print(f"Filtered CIDR ranges have been written to {output_path}")
 
 if __name__ == "__main__":
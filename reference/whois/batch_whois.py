@@ -1,54 +1,230 @@
 import os
-import subprocess
+import re
+import sqlite3
+import time
 import argparse
-import pandas as pd
+import asyncio
+import csv
 from openpyxl import Workbook
 
+DEFAULT_WORKERS = 8
+WHOIS_PORT = 43
+DEFAULT_TIMEOUT = 30
+WHOIS_RETRIES = 3
+DEFAULT_CACHE_FILE = 'whois_cache.sqlite'
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# One scan finds the interesting attributes and the blank lines that separate objects.
+# Matching from the newline lets the regex engine skip ahead to candidate positions,
+# which is much faster than testing a multiline ^ at every character.
+WHOIS_ATTRIBUTE_PATTERN = re.compile(r"\n(route6?|descr|origin):([^\n]*)|\n(?=\r?\n)")
+ORIGIN_PATTERN = re.compile(r"^origin:(.*)$", re.M)
+# Notices servers send instead of an answer when a client queries too fast
+RATE_LIMIT_PATTERN = re.compile(r"^%.*(?:rate limit|limit exceeded|too many|excessive querying|access denied|try again later)|"
+                                r"^query rate limit exceeded", re.M | re.I)
+ERROR_PATTERN = re.compile(r"^%+\s*ERROR", re.M)
+
+whois_cache = None
+whois_timeout = DEFAULT_TIMEOUT
+rate_limiter = None
+whois_connections = None
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = time.monotonic()
+
+    async def wait(self):
+        # Hand out evenly spaced start times, so the concurrent queries together stay under the rate
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class WhoisCache:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (rr TEXT, query TEXT, ts INTEGER, response TEXT, PRIMARY KEY (rr, query))")
+
+    def get(self, rr, query):
+        row = self.connection.execute("SELECT response FROM responses WHERE rr = ? AND query = ? AND ts > ?",
+                                      (rr, query, int(time.time()) - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def put(self, rr, query, response):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (rr, query, int(time.time()), response))
+
+    def close(self):
+        self.connection.close()
+
+class PersistentConnections:
+    # Keeps connections open with the RIPE-style -k flag, so queries skip the TCP handshake
+    def __init__(self):
+        self.idle = []  # (reader, writer) pairs waiting for their next query
+        self.supported = True
+
+    async def exchange(self, reader, writer, line):
+        if rate_limiter is not None:
+            await rate_limiter.wait()
+        writer.write(f"{line}\r\n".encode())
+        await writer.drain()
+        # In -k mode the server ends every answer with two blank lines and keeps the connection open
+        response = bytearray()
+        while not response.endswith(b"\n\n\n"):
+            chunk = await asyncio.wait_for(reader.read(65536), timeout=whois_timeout)
+            if not chunk:
+                return response, False
+            response += chunk
+        return response, True
+
+    def release(self, reader, writer, still_open):
+        if still_open:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def query(self, rr, query):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            try:
+                response, still_open = await self.exchange(reader, writer, query)
+            except ConnectionError:
+                response, still_open = None, False
+            except asyncio.TimeoutError:
+                writer.close()
+                raise
+            if response:
+                self.release(reader, writer, still_open)
+                return await self.checked(rr, query, response)
+            writer.close()  # Dropped by the server while idle, try another one
+
+        if not self.supported:
+            return await fetch_whois(rr, query)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(rr, WHOIS_PORT), timeout=whois_timeout)
+        except ConnectionError:
+            return await fetch_whois(rr, query)  # Retries with backoff
+        try:
+            response, still_open = await self.exchange(reader, writer, f"-k {query}")
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            raise
+        if not still_open:
+            # The server ignored -k and closed after answering, that answer may be an error about
+            # the flag or about the mangled query, so it is thrown away and the plain query is sent
+            writer.close()
+            self.supported = False
+            return await fetch_whois(rr, query)
+        self.release(reader, writer, still_open)
+        return await self.checked(rr, query, response)
+
+    async def checked(self, rr, query, response):
+        response = response.decode('utf-8', errors='replace')
+        if is_rate_limited(response):
+            return await fetch_whois(rr, query)  # Backs off and retries like any rate-limited query
+        return response
+
+    def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+def read_items_from_file(file_path):
+    # Read the whole file and split it at once instead of iterating it line by line
+    with open(file_path, 'r') as f:
+        return [line for line in map(str.strip, f.read().splitlines()) if line]
+
 def read_rr_list(file_path):
     if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            return [line.strip() for line in f]
+        return read_items_from_file(file_path)
     else:
         return []
 
-def query_asn(asn, rr):
-    command = f"whois -h {rr} -- '-i origin {asn}'"
-    return subprocess.getoutput(command)
+async def run_whois(rr, query, semaphore):
+    if whois_cache is not None:
+        response = whois_cache.get(rr, query)
+        if response is not None:
+            return response
+    async with semaphore:
+        if whois_connections is not None:
+            response = await whois_connections.query(rr, query)
+        else:
+            response = await fetch_whois(rr, query)
+    if whois_cache is not None and is_cacheable(response):
+        whois_cache.put(rr, query, response)
+    return response
+
+def is_cacheable(response):
+    # Only answers holding at least one object are kept, never errors, notices or empty bodies
+    return (ORIGIN_PATTERN.search(response) is not None and ERROR_PATTERN.search(response, 0, 2048) is None
+            and not is_rate_limited(response))
+
+async def fetch_whois(rr, query):
+    # Talk to the whois server directly instead of starting a whois process for every query
+    for attempt in range(WHOIS_RETRIES):
+        if rate_limiter is not None:
+            await rate_limiter.wait()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(rr, WHOIS_PORT), timeout=whois_timeout)
+            try:
+                writer.write(f"{query}\r\n".encode())
+                await writer.drain()
+                response = bytearray()
+                while chunk := await asyncio.wait_for(reader.read(65536), timeout=whois_timeout):
+                    response += chunk
+            finally:
+                writer.close()
+        except ConnectionError:
+            if attempt == WHOIS_RETRIES - 1:
+                raise
+        else:
+            response = response.decode('utf-8', errors='replace')
+            if not is_rate_limited(response):
+                return response
+            if attempt == WHOIS_RETRIES - 1:
+                raise ConnectionError(f"rate limited by {rr}")
+        await asyncio.sleep(2 ** attempt)  # Back off when the server drops, refuses or rate limits the connection
+
+def is_rate_limited(response):
+    return RATE_LIMIT_PATTERN.search(response, 0, 2048) is not None  # The notice comes first, before any object
 
-def query_ip(ip, rr):
-    command = f"whois -h {rr} -- '{ip}'"
-    return subprocess.getoutput(command)
+async def query_asn(asn, rr, semaphore):
+    return await run_whois(rr, f"-i origin {asn}", semaphore)
+
+async def query_ip(ip, rr, semaphore):
+    return await run_whois(rr, ip, semaphore)
 
 def parse_whois_output(output):
     results = set()  # Use a set to automatically handle duplicates
-    for block in output.split('\n\n'):
-        route = None
-        descr = None
-        origin = None
-        for line in block.split('\n'):
-            if line.startswith('route:') or line.startswith('route6:'):
-                route = line.split(':', 1)[1].strip()
-            elif line.startswith('descr:'):
-                descr = line.split(':', 1)[1].strip()
-            elif line.startswith('origin:'):
-                origin = line.split(':', 1)[1].strip()
-        if route and descr and origin:
-            results.add((origin, route, descr))  # Adding to a set ensures uniqueness
+    route = descr = origin = None
+    for key, value in WHOIS_ATTRIBUTE_PATTERN.findall('\n' + output):  # So the first line is matched too
+        if not key:  # Blank line, the current object is complete
+            if route and descr and origin:
+                results.add((origin, route, descr))  # Adding to a set ensures uniqueness
+            route = descr = origin = None
+        elif key == 'descr':
+            descr = value.strip()
+        elif key == 'origin':
+            origin = value.strip()
+        else:
+            route = value.strip()
+    if route and descr and origin:
+        results.add((origin, route, descr))
     return list(results)
 
 def extract_asn_from_ip_output(output):
-    for line in output.split('\n'):
-        if line.startswith('origin:'):
-            return line.split(':', 1)[1].strip()
-    return None
+    match = ORIGIN_PATTERN.search(output)
+    return match.group(1).strip() if match else None
 
 def ensure_directory_exists(path):
     if path and not os.path.exists(path):
         os.makedirs(path)
 
 def write_to_text(output_path, identifier, ipv4_data, ipv6_data, asn=None):
-    ensure_directory_exists(output_path)
-
     if asn:
         identifier = f"{identifier}_{asn}".lower()
     else:
@@ -57,53 +233,106 @@ def write_to_text(output_path, identifier, ipv4_data, ipv6_data, asn=None):
     ipv4_path = os.path.join(output_path, f"{identifier}_ipv4.txt")
     ipv6_path = os.path.join(output_path, f"{identifier}_ipv6.txt")
 
-    with open(ipv4_path, 'w') as f:
-        for route in ipv4_data:
-            f.write(f"{route}\n")
+    # Join the routes and write each file in one call instead of one write per route
+    for path, routes in ((ipv4_path, ipv4_data), (ipv6_path, ipv6_data)):
+        with open(path, 'w', buffering=1 << 20) as f:
+            if routes:
+                f.write('\n'.join(routes) + '\n')
 
-    with open(ipv6_path, 'w') as f:
-        for route in ipv6_data:
-            f.write(f"{route}\n")
+async def write_to_csv(output_path, rows):
+    ensure_directory_exists(os.path.dirname(output_path))
+    with open(output_path, 'w', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['Origin', 'Route', 'Description'])
+        async for row in rows:
+            writer.writerow(row)
 
-def write_to_excel(output_path, data):
+async def write_to_excel(output_path, rows):
     ensure_directory_exists(os.path.dirname(output_path))
-    df = pd.DataFrame(data, columns=['Origin', 'Route', 'Description'])
-    df.to_excel(output_path.lower(), index=False)
+    # Write-only mode streams rows to the file instead of keeping every cell in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append(['Origin', 'Route', 'Description'])
+    async for row in rows:
+        ws.append(row)
+    wb.save(output_path.lower())
 
-def read_items_from_file(file_path):
-    with open(file_path, 'r') as f:
-        return [line.strip() for line in f]
+async def resolve_asn(ip, rr, semaphore):
+    output = await query_ip(ip, rr, semaphore)
+    return extract_asn_from_ip_output(output)
 
-def handle_queries(items, rr, query_type, output_format, output_path):
-    data = set()  # Use a set to automatically handle duplicates
+async def query_routes(asn, rr, semaphore):
+    output = await query_asn(asn, rr, semaphore)
+    # Parse in a worker thread so a large answer does not hold up the other queries
+    return await asyncio.get_running_loop().run_in_executor(None, parse_whois_output, output)
 
-    for item in items:
-        if query_type == 'AS':
-            if not item.upper().startswith('AS'):
-                item = 'AS' + item.upper()
-            output = query_asn(item, rr)
-            parsed_data = parse_whois_output(output)
-        elif query_type == 'IP':
-            output = query_ip(item, rr)
-            asn = extract_asn_from_ip_output(output)
-            if asn:
-                output = query_asn(asn, rr)
-                parsed_data = parse_whois_output(output)
-            else:
+# Whois queries only wait on sockets, so they all run in one event loop and are handled as they complete
+async def query_all(items, rr, query_type, workers):
+    semaphore = asyncio.Semaphore(workers)  # At most this many connections to the server at a time
+    sources = {}  # ASN -> items that resolved to it
+
+    async def run_one(key, query):
+        try:
+            return key, await query
+        except asyncio.TimeoutError:
+            return key, TimeoutError("timed out")
+        except OSError as exc:
+            return key, exc
+
+    if query_type == 'IP':
+        for task in asyncio.as_completed([run_one(item, resolve_asn(item, rr, semaphore)) for item in items]):
+            item, asn = await task
+            if isinstance(asn, Exception):
+                print(f"Whois query failed for {item}: {asn}")
+                continue
+            if not asn:
                 print(f"No ASN found for the IP/CIDR: {item}")
                 continue
+            sources.setdefault(asn, []).append(item)
+    else:
+        for item in items:
+            if not item.upper().startswith('AS'):
+                item = 'AS' + item.upper()
+            sources.setdefault(item, []).append(item)
+
+    # Query each ASN once, however many IPs resolved to it
+    for task in asyncio.as_completed([run_one(asn, query_routes(asn, rr, semaphore)) for asn in sources]):
+        asn, parsed_data = await task
+        if isinstance(parsed_data, Exception):
+            print(f"Whois query failed for {asn}: {parsed_data}")
+            continue
+        yield asn, sources[asn], parsed_data
 
-        ipv4_data = [route for origin, route, descr in parsed_data if ':' not in route]
-        ipv6_data = [route for origin, route, descr in parsed_data if ':' in route]
+async def unique_rows(results):
+    seen = set()  # Only used to skip duplicates, rows go straight to the writer
+    async for asn, items, parsed_data in results:
+        for row in parsed_data:
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+def handle_queries(items, rr, query_type, output_format, output_path, workers=DEFAULT_WORKERS):
+    async def export_all():
+        results = query_all(items, rr, query_type, workers)
 
         if output_format == 'text':
-            write_to_text(output_path, item, ipv4_data, ipv6_data, asn if query_type == 'IP' else None)
+            ensure_directory_exists(output_path)  # Once for the batch, every item writes to the same directory
+            async for asn, sources, parsed_data in results:
+                ipv4_data = []
+                ipv6_data = []
+                for origin, route, descr in parsed_data:
+                    (ipv6_data if ':' in route else ipv4_data).append(route)
+                for item in sources:
+                    write_to_text(output_path, item, ipv4_data, ipv6_data, asn if query_type == 'IP' else None)
+        elif output_format == 'csv':
+            await write_to_csv(output_path, unique_rows(results))  # Rows are written as the answers arrive
         elif output_format == 'excel':
-            data.update(parsed_data)  # Use update to add parsed_data to the set
-    
-    if output_format == 'excel':
-        write_to_excel(output_path, list(data))  # Convert set back to list for writing
-    
+            await write_to_excel(output_path, unique_rows(results))
+
+        if whois_connections is not None:
+            whois_connections.close()  # Idle connections belong to this event loop
+
+    asyncio.run(export_all())
     print("Query and export complete.")
 
 def interactive_mode(rr_list):
@@ -127,13 +356,16 @@ def interactive_mode(rr_list):
         return
 
     items = input("Enter ASNs or IP/CIDR (comma-separated) or file path: ").strip().split(',')
-    output_format = input("Choose output format (1: Text, 2: Excel): ").strip()
+    output_format = input("Choose output format (1: Text, 2: Excel, 3: CSV): ").strip()
     if output_format == '1':
         output_format = 'text'
         output_path = input("Enter output directory: ").strip()
     elif output_format == '2':
         output_format = 'excel'
         output_path = input("Enter output path (with .xlsx extension): ").strip()
+    elif output_format == '3':
+        output_format = 'csv'
+        output_path = input("Enter output path (with .csv extension): ").strip()
     else:
         print("Invalid choice.")
         return
@@ -149,23 +381,42 @@ def command_line_mode(args):
     else:
         items = args.items
 
-    handle_queries(items, args.rr, args.query_type, args.output_format, args.output)
+    handle_queries(items, args.rr, args.query_type, args.output_format, args.output, args.workers)
 
 def main():
     parser = argparse.ArgumentParser(description="Batch query routing information using Whois.")
     parser.add_argument('-r', '--rr', type=str, help="Routing Registry (Whois server)")
     parser.add_argument('-i', '--items', nargs='+', help="List of ASNs or IP/CIDR or file containing them")
     parser.add_argument('-o', '--output', type=str, help="Output directory or file path")
-    parser.add_argument('-f', '--output_format', choices=['text', 'excel'], type=str.lower, help="Output format (text or excel)")
+    parser.add_argument('-f', '--output_format', choices=['text', 'csv', 'excel'], type=str.lower, help="Output format (text, csv or excel; csv is much faster than excel for large results)")
     parser.add_argument('-t', '--query_type', choices=['AS', 'IP'], type=str.upper, help="Type of queries (AS or IP)")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help=f"Number of concurrent whois queries (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help=f"Seconds to wait on a whois server before giving up (default: {DEFAULT_TIMEOUT})")
+    parser.add_argument('--rps', type=float, help="Maximum whois queries per second sent to the server (default: no limit)")
+    parser.add_argument('-k', '--keepalive', action='store_true', help="Reuse connections for several queries with the whois -k flag (RIPE-style servers)")
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_FILE, help=f"SQLite file caching whois responses (default: {DEFAULT_CACHE_FILE})")
+    parser.add_argument('--cache_ttl', type=int, default=DEFAULT_CACHE_TTL, help=f"Seconds a cached response stays valid (default: {DEFAULT_CACHE_TTL})")
+    parser.add_argument('--no_cache', action='store_true', help="Always query the whois server, without reading or writing the cache")
     
     args = parser.parse_args()
 
+    global whois_cache, whois_timeout, rate_limiter, whois_connections
+    whois_timeout = args.timeout
+    if args.keepalive:
+        whois_connections = PersistentConnections()
+    if args.rps:
+        rate_limiter = RateLimiter(args.rps)
+    if not args.no_cache:
+        whois_cache = WhoisCache(args.cache, args.cache_ttl)
+
     if args.rr and args.items and args.output and args.output_format and args.query_type:
         command_line_mode(args)
     else:
         rr_list = read_rr_list('routing_registries')
         interactive_mode(rr_list)
 
+    if whois_cache is not None:
+        whois_cache.close()
+
 if __name__ == "__main__":
     main()